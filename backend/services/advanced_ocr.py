@@ -4,11 +4,25 @@ Priority: Google Cloud Vision (90%+) → Gemini Vision (90%+)
 """
 
 import os
+import asyncio
+import hashlib
+import io
+import mimetypes
+import pickle
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
 import pandas as pd
-from typing import Dict, List, Tuple, Optional
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+from openpyxl.utils import get_column_letter
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Tuple, Optional, Union
 import time
+from collections import Counter, OrderedDict
 from pathlib import Path
 from PIL import Image
 
@@ -26,6 +40,222 @@ try:
 except ImportError:
     GEMINI_AVAILABLE = False
 
+# Transient Google API errors (quota, timeout, overload) - retried before falling back
+try:
+    from google.api_core import exceptions as google_exceptions
+    TRANSIENT_API_ERRORS = (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.ServiceUnavailable,
+    )
+except ImportError:
+    TRANSIENT_API_ERRORS = ()
+
+# Numba JIT for table clustering (optional extra: pip install numba - falls back to the NumPy version)
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+@dataclass(eq=False)
+class TextPositions:
+    """
+    OCR words stored as a struct of arrays: texts[i] was read at (ys[i], xs[i])
+    with confidence confs[i]. Iterating yields the legacy (text, (y, x), conf) tuples.
+    """
+    texts: List[str] = field(default_factory=list)
+    ys: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int32))
+    xs: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int32))
+    confs: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.float32))
+    
+    def __post_init__(self):
+        self.texts = list(self.texts)
+        self.ys = np.asarray(self.ys, dtype=np.int32)
+        self.xs = np.asarray(self.xs, dtype=np.int32)
+        self.confs = np.asarray(self.confs, dtype=np.float32)
+    
+    @classmethod
+    def from_tuples(cls, items: Iterable[Tuple[str, Tuple[int, int], float]]) -> "TextPositions":
+        """Build from (text, (y, x), confidence) tuples"""
+        items = list(items)
+        return cls(
+            texts=[text for text, _, _ in items],
+            ys=[y for _, (y, _), _ in items],
+            xs=[x for _, (_, x), _ in items],
+            confs=[conf for _, _, conf in items],
+        )
+    
+    def copy(self) -> "TextPositions":
+        return TextPositions(list(self.texts), self.ys.copy(), self.xs.copy(), self.confs.copy())
+    
+    def __eq__(self, other) -> bool:
+        # The generated __eq__ would compare arrays with ==, which has no single truth value
+        if not isinstance(other, TextPositions):
+            return NotImplemented
+        return (
+            self.texts == other.texts
+            and np.array_equal(self.ys, other.ys)
+            and np.array_equal(self.xs, other.xs)
+            and np.array_equal(self.confs, other.confs)
+        )
+    
+    def __len__(self) -> int:
+        return len(self.texts)
+    
+    def __iter__(self) -> Iterator[Tuple[str, Tuple[int, int], float]]:
+        for text, y, x, conf in zip(self.texts, self.ys.tolist(), self.xs.tolist(), self.confs.tolist()):
+            yield text, (y, x), conf
+
+
+# Process-wide LRU memo in front of the disk cache, keyed by (backend, path, mtime, size).
+# Module level because the API builds a new AdvancedOCR per request; it only ever holds
+# results the disk cache would also keep, so failures and fallbacks are still retried
+_MEMO_MAX_ENTRIES = 256
+_memo: "OrderedDict[tuple, TextPositions]" = OrderedDict()
+_memo_lock = threading.Lock()
+
+
+def _memo_get(key: Optional[tuple]) -> Optional[TextPositions]:
+    if key is None:
+        return None
+    with _memo_lock:
+        text_positions = _memo.get(key)
+        if text_positions is None:
+            return None
+        _memo.move_to_end(key)
+    # Copy so callers can't mutate the memoized result
+    return text_positions.copy()
+
+
+def _memo_put(key: Optional[tuple], text_positions: TextPositions):
+    if key is None:
+        return
+    with _memo_lock:
+        _memo[key] = text_positions.copy()
+        _memo.move_to_end(key)
+        while len(_memo) > _MEMO_MAX_ENTRIES:
+            _memo.popitem(last=False)
+
+
+def _cluster_positions_numpy(ys: np.ndarray, xs: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, int]:
+    """
+    Numeric core of table detection. Returns (by_row, row_ids, col_ids, n_cols):
+    word indices in reading order (row, then x), each word's row, each word's
+    nearest column center, and the number of columns found (0 for a single word).
+    """
+    n = len(ys)
+    
+    # Rows: break wherever the next word down is at least y_threshold lower
+    order = np.argsort(ys, kind='stable')
+    gaps = np.diff(ys[order])
+    median_gap = float(np.median(gaps)) if gaps.size else 30.0
+    y_threshold = max(15, min(50, median_gap * 1.3))
+    
+    row_ids = np.empty(n, dtype=np.int64)
+    row_ids[order] = np.r_[0, np.cumsum(gaps >= y_threshold)]
+    y_rank = np.empty(n, dtype=np.int64)
+    y_rank[order] = np.arange(n)
+    by_row = np.lexsort((y_rank, xs, row_ids))
+    
+    # Columns: split sorted xs at wide gaps, then snap every word to the nearest cluster median
+    col_ids = np.zeros(n, dtype=np.int64)
+    n_cols = 0
+    if n > 1:
+        xs_sorted = np.sort(xs)
+        x_gaps = np.diff(xs_sorted)
+        col_gap_threshold = max(20, float(np.median(x_gaps)) * 2)
+        col_breaks = np.flatnonzero(x_gaps >= col_gap_threshold) + 1
+        centers = np.asarray([np.median(cluster) for cluster in np.split(xs_sorted, col_breaks)])
+        col_ids = np.abs(xs[:, None] - centers[None, :]).argmin(axis=1)
+        n_cols = len(centers)
+    
+    return by_row, row_ids, col_ids, n_cols
+
+
+if NUMBA_AVAILABLE:
+    # Explicit signature compiles at import (app startup) instead of on the first OCR request;
+    # detect_table_structure always passes TextPositions' int32 arrays
+    @njit("(int32[:], int32[:])", cache=True)
+    def _cluster_positions_jit(ys, xs):
+        """Same contract as _cluster_positions_numpy, as explicit loops for Numba"""
+        n = ys.shape[0]
+        
+        # Rows
+        order = np.argsort(ys, kind='mergesort')
+        median_gap = 30.0
+        if n > 1:
+            gaps = np.empty(n - 1, dtype=np.float64)
+            for i in range(n - 1):
+                gaps[i] = ys[order[i + 1]] - ys[order[i]]
+            median_gap = np.median(gaps)
+        y_threshold = max(15.0, min(50.0, median_gap * 1.3))
+        
+        row_ids = np.empty(n, dtype=np.int64)
+        by_row = order.copy()
+        row = 0
+        start = 0
+        row_ids[order[0]] = 0
+        for i in range(1, n + 1):
+            if i == n or ys[order[i]] - ys[order[i - 1]] >= y_threshold:
+                segment = order[start:i]
+                by_row[start:i] = segment[np.argsort(xs[segment], kind='mergesort')]
+                row += 1
+                start = i
+            if i < n:
+                row_ids[order[i]] = row
+        
+        # Columns
+        col_ids = np.zeros(n, dtype=np.int64)
+        n_cols = 0
+        if n > 1:
+            xs_sorted = np.sort(xs)
+            x_gaps = np.empty(n - 1, dtype=np.float64)
+            for i in range(n - 1):
+                x_gaps[i] = xs_sorted[i + 1] - xs_sorted[i]
+            col_gap_threshold = max(20.0, np.median(x_gaps) * 2)
+            
+            centers = np.empty(n, dtype=np.float64)
+            start = 0
+            for i in range(1, n + 1):
+                if i == n or xs_sorted[i] - xs_sorted[i - 1] >= col_gap_threshold:
+                    centers[n_cols] = np.median(xs_sorted[start:i])
+                    n_cols += 1
+                    start = i
+            
+            for j in range(n):
+                best = 0
+                best_dist = abs(xs[j] - centers[0])
+                for c in range(1, n_cols):
+                    dist = abs(xs[j] - centers[c])
+                    if dist < best_dist:
+                        best = c
+                        best_dist = dist
+                col_ids[j] = best
+        
+        return by_row, row_ids, col_ids, n_cols
+    
+    _cluster_positions = _cluster_positions_jit
+else:
+    _cluster_positions = _cluster_positions_numpy
+
+
+class _RateLimiter:
+    """Enforces a minimum interval between API dispatches (thread-safe, so worker threads share it)"""
+    
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self.last_call_ts = 0.0
+        self._lock = threading.Lock()
+    
+    def wait(self):
+        with self._lock:
+            delay = self.min_interval - (time.monotonic() - self.last_call_ts)
+            if delay > 0:
+                time.sleep(delay)
+            self.last_call_ts = time.monotonic()
+
 
 class AdvancedOCR:
     """
@@ -34,6 +264,12 @@ class AdvancedOCR:
     Fallback: Google Gemini Vision (requires API key, great for handwriting)
     """
     
+    # Maximum number of images Google Cloud Vision accepts per batch_annotate_images call
+    VISION_BATCH_SIZE = 16
+    
+    # Longest edge (px) sent to the OCR APIs - accuracy plateaus well below phone-camera resolution
+    MAX_UPLOAD_EDGE = 3000
+    
     def __init__(self):
         """Initialize OCR with backend selection priority"""
         self.backend = None
@@ -50,46 +286,110 @@ class AdvancedOCR:
                 print(f"[OCR] Google Cloud Vision error: {e}")
                 self.client = None
         
+        # Gemini model is built once whenever a key is set - it is the primary backend
+        # without Vision credentials and the per-image fallback with them
+        self._gemini_fallback_model = None
+        gemini_key = os.getenv('GEMINI_API_KEY')
+        if GEMINI_AVAILABLE and gemini_key and gemini_key != 'your_gemini_api_key':
+            try:
+                genai.configure(api_key=gemini_key)
+                self._gemini_fallback_model = genai.GenerativeModel('gemini-2.0-flash')
+            except Exception as e:
+                print(f"[OCR] Gemini Vision error: {e}")
+        self.model = self._gemini_fallback_model
+        
         # Priority 2: Gemini Vision (90%+ for handwriting)
-        if self.backend is None:
-            gemini_key = os.getenv('GEMINI_API_KEY')
-            if GEMINI_AVAILABLE and gemini_key and gemini_key != 'your_gemini_api_key':
-                try:
-                    genai.configure(api_key=gemini_key)
-                    self.model = genai.GenerativeModel('gemini-2.0-flash')
-                    self.backend = "GEMINI_VISION"
-                    print("[OCR] Using Google Gemini Vision (90%+ accuracy for handwriting)")
-                except Exception as e:
-                    print(f"[OCR] Gemini Vision error: {e}")
-                    self.model = None
+        if self.backend is None and self.model is not None:
+            self.backend = "GEMINI_VISION"
+            print("[OCR] Using Google Gemini Vision (90%+ accuracy for handwriting)")
         
         if self.backend is None:
             raise RuntimeError("No OCR backend available. Set GOOGLE_APPLICATION_CREDENTIALS or GEMINI_API_KEY")
         
         # Minimum confidence threshold
         self.min_confidence = 0.3
+        
+        # Run OpenCV image ops through OpenCL (GPU/iGPU) when a device is present
+        self.use_opencl = cv2.ocl.haveOpenCL()
+        if self.use_opencl:
+            cv2.ocl.setUseOpenCL(True)
+        
+        # Dispatch limits: concurrent in-flight API calls and min seconds between them.
+        # Enforced per call in _call_with_retry, so async and threaded callers share the quota
+        self.max_concurrency = int(os.getenv('OCR_MAX_CONCURRENCY', '4'))
+        self._dispatch_slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._sem = None
+        self._sem_loop = None
+        self._rate_limiter = _RateLimiter(float(os.getenv('OCR_MIN_REQUEST_INTERVAL', '0.1')))
+        
+        # Persistent OCR result cache, keyed by file content hash + backend
+        self._cache_dir = Path(os.getenv('OCR_CACHE_DIR', '~/.cache/advanced_ocr')).expanduser()
+        try:
+            self._cache_dir.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            print(f"[OCR] Result cache disabled: {e}")
+            self._cache_dir = None
+
     
     def _deskew(self, gray: np.ndarray) -> np.ndarray:
-        """Deskew image using Hough line detection"""
-        edges = cv2.Canny(gray, 50, 150, apertureSize=3)
-        lines = cv2.HoughLines(edges, 1, np.pi / 180, 200)
+        """Deskew image using projection-profile variance over trial angles"""
+        if min(gray.shape[:2]) < 8:
+            return gray
         
-        if lines is None:
+        # Full-size resize and final rotation go through OpenCL when available (UMat)
+        src = cv2.UMat(gray) if self.use_opencl else gray
+        
+        # Search on a binarized 25% copy - level text lines give the sharpest row profile.
+        # The copy is small, so the angle search itself stays on the CPU
+        small = cv2.resize(src, None, fx=0.25, fy=0.25, interpolation=cv2.INTER_AREA)
+        _, binary = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+        if isinstance(binary, cv2.UMat):
+            binary = binary.get()
+        if cv2.countNonZero(binary) == 0:
             return gray
         
-        angles = []
-        for rho, theta in lines[:, 0]:
-            angle = (theta * 180 / np.pi) - 90
-            if -45 < angle < 45:
-                angles.append(angle)
+        (sh, sw) = binary.shape[:2]
+        angles = np.arange(-10, 10, 0.5)
+        matrices = [cv2.getRotationMatrix2D((sw // 2, sh // 2), float(angle), 1.0) for angle in angles]
+        scores = np.empty(len(angles))
+        for i, M in enumerate(matrices):
+            rotated = cv2.warpAffine(binary, M, (sw, sh), flags=cv2.INTER_NEAREST)
+            projection = rotated.sum(axis=1, dtype=np.float64)
+            scores[i] = np.var(np.diff(projection))
         
-        if not angles:
+        # Only rotate when some angle beats leaving the image as-is
+        best = int(np.argmax(scores))
+        if scores[best] <= scores[np.flatnonzero(angles == 0)[0]]:
             return gray
         
-        median_angle = np.median(angles)
         (h, w) = gray.shape[:2]
-        M = cv2.getRotationMatrix2D((w // 2, h // 2), median_angle, 1.0)
-        return cv2.warpAffine(gray, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+        M = cv2.getRotationMatrix2D((w // 2, h // 2), float(angles[best]), 1.0)
+        deskewed = cv2.warpAffine(src, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+        return deskewed.get() if isinstance(deskewed, cv2.UMat) else deskewed
+    
+    @staticmethod
+    def _is_transient_error(error: Exception) -> bool:
+        """True for rate-limit/quota/timeout errors that are likely to succeed on retry"""
+        if TRANSIENT_API_ERRORS and isinstance(error, TRANSIENT_API_ERRORS):
+            return True
+        message = str(error).lower()
+        return any(marker in message for marker in ("rate limit", "quota", "429", "deadline"))
+    
+    def _call_with_retry(self, fn, *args, max_tries: int = 3, base: float = 0.5, cap: float = 8.0, **kwargs):
+        """Call an API function, retrying transient errors with exponential backoff"""
+        for attempt in range(max_tries):
+            try:
+                # Every attempt takes a concurrency slot and counts against the request
+                # interval, retries and fallbacks included; backoff sleeps hold neither
+                with self._dispatch_slots:
+                    self._rate_limiter.wait()
+                    return fn(*args, **kwargs)
+            except Exception as e:
+                if attempt == max_tries - 1 or not self._is_transient_error(e):
+                    raise
+                delay = min(cap, base * 2 ** attempt)
+                print(f"[OCR] Transient API error ({e}), retrying in {delay}s...")
+                time.sleep(delay)
     
     def preprocess_image(self, image: np.ndarray) -> np.ndarray:
         """Minimal preprocessing - let Tesseract LSTM do the heavy lifting"""
@@ -104,47 +404,165 @@ class AdvancedOCR:
         
         return normalized
     
-    def extract_with_google_vision(self, image_path: str) -> List[Tuple[str, Tuple[int, int], float]]:
-        """Extract text using Google Cloud Vision API (90%+ accuracy)"""
-        with open(image_path, 'rb') as image_file:
-            content = image_file.read()
-        
-        image = vision.Image(content=content)
-        response = self.client.document_text_detection(image=image)
-        
-        text_positions = []
+    def _parse_vision_response(self, response, scale: float = 1.0) -> TextPositions:
+        """Convert a Vision AnnotateImageResponse into positioned words (divided by scale back to original pixels)"""
+        texts = []
+        confs = []
+        centers = []
         
         # Process document text with layout
         if response.full_text_annotation:
             for page in response.full_text_annotation.pages:
+                words = []    # (text, confidence) of every kept word on the page
+                coords = []   # (y, x) of every kept word's bounding box vertices
+                offsets = []  # index of each word's first vertex in coords
+                
                 for block in page.blocks:
                     for paragraph in block.paragraphs:
                         for word in paragraph.words:
-                            text = ''.join([symbol.text for symbol in word.symbols])
-                            confidence = np.mean([symbol.confidence for symbol in word.symbols]) if word.symbols else 0.0
+                            symbols = word.symbols
+                            text = ''.join([symbol.text for symbol in symbols])
+                            confidence = (sum(symbol.confidence for symbol in symbols) / len(symbols)) if symbols else 0.0
                             
                             # Filter low confidence
                             if confidence < 0.2 or not text.strip():
                                 continue
                             
-                            # Get bounding box center
                             vertices = word.bounding_box.vertices
                             if vertices:
-                                center_y = int(np.mean([v.y for v in vertices]))
-                                center_x = int(np.mean([v.x for v in vertices]))
-                                text_positions.append((text, (center_y, center_x), confidence))
+                                offsets.append(len(coords))
+                                coords.extend((v.y, v.x) for v in vertices)
+                                words.append((text, confidence))
+                
+                if not words:
+                    continue
+                
+                # Bounding box centers for the whole page in one reduction
+                counts = np.diff(np.r_[offsets, len(coords)])
+                page_centers = np.add.reduceat(np.asarray(coords, dtype=np.float64), offsets, axis=0) / (counts[:, None] * scale)
+                centers.append(page_centers.astype(np.int32))
+                texts.extend(text for text, _ in words)
+                confs.extend(confidence for _, confidence in words)
         
-        return text_positions
+        if not texts:
+            return TextPositions()
+        centers = np.concatenate(centers)
+        return TextPositions(texts, centers[:, 0], centers[:, 1], confs)
+    
+    def _downscale_for_upload(self, content: bytes) -> Tuple[bytes, float]:
+        """Re-encode images longer than MAX_UPLOAD_EDGE as JPEG; returns (bytes, scale applied)"""
+        try:
+            # PIL reads only the header here, the image is not decoded
+            width, height = Image.open(io.BytesIO(content)).size
+        except Exception:
+            return content, 1.0
+        
+        longest = max(width, height)
+        if longest <= self.MAX_UPLOAD_EDGE:
+            return content, 1.0
+        
+        image = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            return content, 1.0
+        
+        scale = self.MAX_UPLOAD_EDGE / longest
+        (h, w) = image.shape[:2]
+        resized = cv2.resize(image, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+        ok, encoded = cv2.imencode('.jpg', resized, [cv2.IMWRITE_JPEG_QUALITY, 92])
+        if not ok:
+            return content, 1.0
+        return encoded.tobytes(), scale
+    
+    def _read_image(self, image_path: str) -> Optional[bytes]:
+        """Bytes of a local image, read once and shared by cache hashing and upload (None for gs:// or unreadable)"""
+        if image_path.startswith('gs://'):
+            return None
+        try:
+            with open(image_path, 'rb') as image_file:
+                return image_file.read()
+        except OSError:
+            return None
+    
+    def _vision_image(self, image_path: str, content: Optional[bytes] = None):
+        """
+        Build a Vision image - gs:// URIs are referenced in place (nothing uploaded),
+        local files are downscaled (read here unless content is passed). Returns (image, scale applied).
+        """
+        if image_path.startswith('gs://'):
+            return vision.Image(source=vision.ImageSource(gcs_image_uri=image_path)), 1.0
+        
+        if content is None:
+            with open(image_path, 'rb') as image_file:
+                content = image_file.read()
+        content, scale = self._downscale_for_upload(content)
+        return vision.Image(content=content), scale
+    
+    def extract_with_google_vision(self, image_path: str, content: Optional[bytes] = None) -> TextPositions:
+        """Extract text using Google Cloud Vision API (90%+ accuracy)"""
+        image, scale = self._vision_image(image_path, content)
+        response = self._call_with_retry(self.client.document_text_detection, image=image)
+        
+        return self._parse_vision_response(response, scale)
+    
+    def extract_batch_with_google_vision(self, image_paths: List[str], contents: Optional[List[Optional[bytes]]] = None) -> List[TextPositions]:
+        """
+        Extract text from many images with one Vision request per VISION_BATCH_SIZE images.
+        An unreadable image or a failed chunk only empties its own results, so the
+        caller falls back for those images alone.
+        """
+        results = [TextPositions() for _ in image_paths]
+        if contents is None:
+            contents = [None] * len(image_paths)
+        
+        for start in range(0, len(image_paths), self.VISION_BATCH_SIZE):
+            requests = []
+            indices = []
+            scales = []
+            for i in range(start, min(start + self.VISION_BATCH_SIZE, len(image_paths))):
+                try:
+                    image, scale = self._vision_image(image_paths[i], contents[i])
+                except Exception as e:
+                    print(f"[ERROR] Could not read {image_paths[i]} for Google Cloud Vision: {e}")
+                    continue
+                requests.append(vision.AnnotateImageRequest(
+                    image=image,
+                    features=[vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)]
+                ))
+                indices.append(i)
+                scales.append(scale)
+            
+            if not requests:
+                continue
+            
+            try:
+                response = self._call_with_retry(self.client.batch_annotate_images, requests=requests)
+            except Exception as e:
+                print(f"[ERROR] Google Cloud Vision batch request failed: {e}")
+                continue
+            
+            # Responses come back in request order; a failed image does not fail the batch
+            for i, image_response, scale in zip(indices, response.responses, scales):
+                if image_response.error.message:
+                    print(f"[ERROR] Google Cloud Vision batch item failed: {image_response.error.message}")
+                else:
+                    results[i] = self._parse_vision_response(image_response, scale)
+        
+        return results
     
-    def extract_with_gemini(self, image_path: str) -> List[Tuple[str, Tuple[int, int], float]]:
+    def extract_with_gemini(self, image_path: str, content: Optional[bytes] = None) -> TextPositions:
         """Extract text using Google Gemini Vision (excellent for handwriting)"""
         try:
-            # Read and encode image
-            with open(image_path, 'rb') as f:
-                image_data = f.read()
+            # Gemini takes the encoded file directly - no need to decode it first
+            image_bytes = content
+            if image_bytes is None:
+                with open(image_path, 'rb') as f:
+                    image_bytes = f.read()
+            mime_type = mimetypes.guess_type(image_path)[0] or "image/jpeg"
             
-            # Open with PIL for Gemini
-            pil_image = Image.open(image_path)
+            # Gemini positions are grid estimates, not pixels, so the scale needs no undoing
+            image_bytes, scale = self._downscale_for_upload(image_bytes)
+            if scale != 1.0:
+                mime_type = "image/jpeg"
             
             # Prompt optimized for handwritten text extraction with positioning
             prompt = """Analyze this handwritten document image and extract ALL visible text.
@@ -160,9 +578,12 @@ Example: "Book|5|10|85" means "Book" at row 5, column 10, 85% confident
 Extract EVERYTHING you can read, even if confidence is low. Be thorough."""
 
             # Generate content with Gemini
-            response = self.model.generate_content([prompt, pil_image])
+            response = self._call_with_retry(
+                self.model.generate_content,
+                [{"mime_type": mime_type, "data": image_bytes}, prompt]
+            )
             
-            text_positions = []
+            texts, ys, xs, confs = [], [], [], []
             
             # Parse response
             if response.text:
@@ -179,212 +600,290 @@ Extract EVERYTHING you can read, even if confidence is low. Be thorough."""
                                 conf = float(parts[3].strip().replace('%', '')) / 100.0
                                 
                                 if text and conf >= 0.2:  # Lenient threshold for handwriting
-                                    text_positions.append((text, (y * 20, x * 20), conf))
+                                    texts.append(text)
+                                    ys.append(y * 20)
+                                    xs.append(x * 20)
+                                    confs.append(conf)
                         except (ValueError, IndexError):
                             continue
             
-            return text_positions
+            return TextPositions(texts, ys, xs, confs)
             
         except Exception as e:
             print(f"[ERROR] Gemini extraction failed: {e}")
-            return []
+            return TextPositions()
     
-    def extract_with_tesseract(self, image_path: str) -> List[Tuple[str, Tuple[int, int], float]]:
+    def extract_with_tesseract(self, image_path: str) -> TextPositions:
         """Removed - Tesseract no longer supported"""
         raise NotImplementedError("Tesseract backend has been removed")
     
-    def extract_text_with_positions(self, image_path: str) -> List[Tuple[str, Tuple[int, int], float]]:
-        """Main extraction method - uses best available backend with fallback"""
+    def _cache_path(self, content: Optional[bytes]) -> Optional[Path]:
+        """Cache file for an image - SHA-256 of its bytes, so renames still hit"""
+        if self._cache_dir is None or content is None:
+            return None
+        digest = hashlib.sha256(content).hexdigest()
+        return self._cache_dir / f"{digest}_{self.backend}.pkl"
+    
+    def _load_cached(self, cache_path: Optional[Path]) -> Optional[TextPositions]:
+        """Read a cached result, or None on a miss"""
+        if cache_path is None or not cache_path.exists():
+            return None
+        try:
+            with open(cache_path, 'rb') as f:
+                cached = pickle.load(f)
+            return cached if isinstance(cached, TextPositions) else None
+        except Exception as e:
+            print(f"[OCR] Ignoring unreadable cache entry {cache_path.name}: {e}")
+            return None
+    
+    def _is_cacheable(self, text_positions: TextPositions, source: str) -> bool:
+        """
+        Only non-empty results from the primary backend are cached (disk and memo);
+        empty results and fallback-backend results get retried next time.
+        """
+        return bool(text_positions) and source == self.backend
+    
+    def _memo_key(self, image_path: str) -> Optional[tuple]:
+        """In-process memo key - a replaced file gets a new mtime/size and misses"""
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        return (self.backend, os.path.abspath(image_path), stat.st_mtime_ns, stat.st_size)
+    
+    def _store_cached(self, cache_path: Optional[Path], text_positions: TextPositions, source: str):
+        """Write a result to the disk cache if it is cacheable"""
+        if cache_path is None or not self._is_cacheable(text_positions, source):
+            return
+        try:
+            # Write to a temp file and rename so concurrent readers never see a partial pickle
+            with tempfile.NamedTemporaryFile(dir=cache_path.parent, suffix='.tmp', delete=False) as f:
+                pickle.dump(text_positions, f)
+            os.replace(f.name, cache_path)
+        except Exception as e:
+            print(f"[OCR] Could not write cache entry: {e}")
+    
+    def _gemini_fallback(self, image_path: str, content: Optional[bytes] = None) -> TextPositions:
+        """Retry an image on Gemini Vision when Google Vision fails or finds nothing"""
+        if self._gemini_fallback_model is None:
+            return TextPositions()
+        print("[OCR] Falling back to Gemini Vision...")
+        return self.extract_with_gemini(image_path, content)
+    
+    def extract_text_with_positions(self, image_path: str) -> TextPositions:
+        """Main extraction method - in-process memo, then disk cache, then best backend"""
+        text_positions, miss = self._lookup_cached(image_path)
+        if text_positions is None:
+            text_positions = self._extract_and_store(image_path, *miss)
+        return text_positions
+    
+    def _lookup_cached(self, image_path: str) -> Tuple[Optional[TextPositions], tuple]:
+        """
+        Memo, then disk cache. Returns (result or None, (memo key, cache path, image bytes)) -
+        on a miss the bytes that were hashed are handed on to the backend, so the file is read once
+        """
+        memo_key = self._memo_key(image_path)
+        text_positions = _memo_get(memo_key)
+        if text_positions is not None:
+            return text_positions, (memo_key, None, None)
+        
+        content = self._read_image(image_path)
+        cache_path = self._cache_path(content)
+        text_positions = self._load_cached(cache_path)
+        if text_positions is not None:
+            _memo_put(memo_key, text_positions)
+            return text_positions, (memo_key, cache_path, None)
+        return None, (memo_key, cache_path, content)
+    
+    def _extract_and_store(self, image_path: str, memo_key: Optional[tuple], cache_path: Optional[Path],
+                           content: Optional[bytes]) -> TextPositions:
+        """Backend extraction for a cache miss; the result is stored only if cacheable"""
+        text_positions, source = self._extract_from_backend(image_path, content)
+        if self._is_cacheable(text_positions, source):
+            self._store_cached(cache_path, text_positions, source)
+            _memo_put(memo_key, text_positions)
+        return text_positions
+    
+    def _extract_from_backend(self, image_path: str, content: Optional[bytes] = None) -> Tuple[TextPositions, str]:
+        """Uncached extraction - uses best available backend with fallback; returns (result, backend that produced it)"""
         if self.backend == "GOOGLE_VISION":
             try:
-                result = self.extract_with_google_vision(image_path)
+                result = self.extract_with_google_vision(image_path, content)
                 if result:  # If Google Vision succeeded
-                    return result
+                    return result, "GOOGLE_VISION"
                 # If empty result, try fallback
                 print("[OCR] Google Vision returned no results, trying Gemini fallback...")
-                if GEMINI_AVAILABLE and os.getenv('GEMINI_API_KEY') and os.getenv('GEMINI_API_KEY') != 'your_gemini_api_key':
-                    try:
-                        genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-                        self.model = genai.GenerativeModel('gemini-2.0-flash')
-                        return self.extract_with_gemini(image_path)
-                    except Exception as e:
-                        print(f"[ERROR] Gemini fallback failed: {e}")
-                return []
+                return self._gemini_fallback(image_path, content), "GEMINI_VISION"
             except Exception as e:
                 print(f"[ERROR] Google Cloud Vision extraction error: {e}")
                 # Try fallback on error
-                if GEMINI_AVAILABLE and os.getenv('GEMINI_API_KEY') and os.getenv('GEMINI_API_KEY') != 'your_gemini_api_key':
-                    try:
-                        print("[OCR] Falling back to Gemini Vision...")
-                        genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-                        self.model = genai.GenerativeModel('gemini-2.0-flash')
-                        return self.extract_with_gemini(image_path)
-                    except Exception as e2:
-                        print(f"[ERROR] Gemini fallback also failed: {e2}")
-                return []
+                return self._gemini_fallback(image_path, content), "GEMINI_VISION"
+        elif self.backend == "GEMINI_VISION":
+            return self.extract_with_gemini(image_path, content), "GEMINI_VISION"
+        else:
+            raise RuntimeError(f"Unknown backend: {self.backend}")
+    
+    def extract_text_with_positions_batch(self, image_paths: List[str]) -> List[TextPositions]:
+        """
+        Batch extraction - memoized/cached images are skipped, the rest go to the backend
+        VISION_BATCH_SIZE at a time, so only one batch of image bytes is held in memory
+        """
+        results = [None] * len(image_paths)
+        pending = []  # (index, memo key, cache path, image bytes) of misses not yet sent
+        
+        def flush():
+            fresh = self._extract_batch_from_backend(
+                [image_paths[i] for i, _, _, _ in pending], [content for _, _, _, content in pending]
+            )
+            for (i, memo_key, cache_path, _), (text_positions, source) in zip(pending, fresh):
+                results[i] = text_positions
+                if self._is_cacheable(text_positions, source):
+                    self._store_cached(cache_path, text_positions, source)
+                    _memo_put(memo_key, text_positions)
+            pending.clear()
+        
+        for i, image_path in enumerate(image_paths):
+            results[i], miss = self._lookup_cached(image_path)
+            if results[i] is None:
+                pending.append((i, *miss))
+                if len(pending) == self.VISION_BATCH_SIZE:
+                    flush()
+        if pending:
+            flush()
+        
+        return results
+    
+    def _extract_batch_from_backend(self, image_paths: List[str], contents: Optional[List[Optional[bytes]]] = None) -> List[Tuple[TextPositions, str]]:
+        """
+        Uncached batch extraction - one Vision round-trip per VISION_BATCH_SIZE images,
+        same fallback rules. Returns (result, backend that produced it) per image.
+        """
+        if contents is None:
+            contents = [None] * len(image_paths)
+        
+        if self.backend == "GOOGLE_VISION":
+            try:
+                results = self.extract_batch_with_google_vision(image_paths, contents)
+            except Exception as e:
+                print(f"[ERROR] Google Cloud Vision batch extraction error: {e}")
+                return [(self._gemini_fallback(path, content), "GEMINI_VISION") for path, content in zip(image_paths, contents)]
+            
+            return [
+                (result, "GOOGLE_VISION") if result else (self._gemini_fallback(path, content), "GEMINI_VISION")
+                for path, content, result in zip(image_paths, contents, results)
+            ]
         elif self.backend == "GEMINI_VISION":
-            return self.extract_with_gemini(image_path)
+            # Gemini has no batch endpoint, images are sent one at a time
+            return [(self.extract_with_gemini(path, content), "GEMINI_VISION") for path, content in zip(image_paths, contents)]
         else:
             raise RuntimeError(f"Unknown backend: {self.backend}")
     
-    def detect_table_structure(self, text_positions: List[Tuple[str, Tuple[int, int], float]]) -> List[List[str]]:
+    def _loop_semaphore(self) -> asyncio.Semaphore:
+        """Concurrency semaphore for the running event loop (asyncio primitives can't be shared across loops)"""
+        loop = asyncio.get_running_loop()
+        if self._sem_loop is not loop:
+            self._sem = asyncio.Semaphore(self.max_concurrency)
+            self._sem_loop = loop
+        return self._sem
+    
+    async def extract_text_with_positions_async(self, image_path: str) -> TextPositions:
+        """
+        Async extraction - memo hits return straight away; anything else waits for an
+        OCR_MAX_CONCURRENCY slot before the file is read, so queued images hold no bytes,
+        and the blocking lookup/API call runs in a worker thread
+        """
+        text_positions = _memo_get(self._memo_key(image_path))
+        if text_positions is not None:
+            return text_positions
+        async with self._loop_semaphore():
+            return await asyncio.to_thread(self.extract_text_with_positions, image_path)
+    
+    async def extract_batch(self, image_paths: List[str]) -> List[TextPositions]:
+        """Extract many images concurrently, bounded by OCR_MAX_CONCURRENCY"""
+        return await asyncio.gather(*[self.extract_text_with_positions_async(p) for p in image_paths])
+    
+    def detect_table_structure(self, text_positions: Union[TextPositions, List[Tuple[str, Tuple[int, int], float]]]) -> List[List[str]]:
         """Detect table structure from positioned text"""
+        if not isinstance(text_positions, TextPositions):
+            text_positions = TextPositions.from_tuples(text_positions)
         if not text_positions:
             return []
         
-        # Group by Y position (rows)
-        ys = [y for _, (y, _), _ in text_positions]
-        ys_sorted = sorted(ys)
-        gaps = [ys_sorted[i + 1] - ys_sorted[i] for i in range(len(ys_sorted) - 1)]
-        median_gap = np.median(gaps) if gaps else 30
-        y_threshold = max(15, min(50, median_gap * 1.3))
-        
-        rows = []
-        current_row = []
-        previous_y = None
-        
-        for text, (y, x), confidence in text_positions:
-            if previous_y is None or abs(y - previous_y) < y_threshold:
-                current_row.append((text, x, confidence))
-            else:
-                if current_row:
-                    current_row.sort(key=lambda item: item[1])
-                    rows.append([item[0] for item in current_row])
-                current_row = [(text, x, confidence)]
-            previous_y = y
-        
-        if current_row:
-            current_row.sort(key=lambda item: item[1])
-            rows.append([item[0] for item in current_row])
-        
-        # Adaptive column detection
-        if rows and text_positions:
-            xs = [x for _, _, (_, x), _ in [(None, None, (0, x), None) for _, (_, x), _ in text_positions]]
+        texts = text_positions.texts
+        by_row, row_ids, col_ids, n_cols = _cluster_positions(
+            np.ascontiguousarray(text_positions.ys), np.ascontiguousarray(text_positions.xs)
+        )
+        rows = np.split(by_row, np.flatnonzero(np.diff(row_ids[by_row])) + 1)
+        
+        # Realign rows if we found reasonable columns
+        if 1 < n_cols < len(rows[0]):
+            aligned_rows = []
             
-            if xs and len(xs) > 1:
-                xs_sorted = sorted(xs)
-                x_gaps = [xs_sorted[i + 1] - xs_sorted[i] for i in range(len(xs_sorted) - 1)]
-                
-                if x_gaps:
-                    median_x_gap = np.median(x_gaps)
-                    col_gap_threshold = max(20, median_x_gap * 2)
-                    
-                    column_clusters = []
-                    current_cluster = [xs_sorted[0]]
-                    
-                    for i in range(1, len(xs_sorted)):
-                        if xs_sorted[i] - current_cluster[-1] < col_gap_threshold:
-                            current_cluster.append(xs_sorted[i])
-                        else:
-                            col_center = np.median(current_cluster)
-                            column_clusters.append(col_center)
-                            current_cluster = [xs_sorted[i]]
-                    
-                    if current_cluster:
-                        col_center = np.median(current_cluster)
-                        column_clusters.append(col_center)
-                    
-                    # Realign rows if we found reasonable columns
-                    if 1 < len(column_clusters) < len(rows[0]) if rows else False:
-                        max_len = len(column_clusters)
-                        aligned_rows = []
-                        
-                        for row in rows:
-                            aligned_row = ["" for _ in range(max_len)]
-                            for cell_text in row:
-                                for text, (_, cell_x), _ in text_positions:
-                                    if text == cell_text:
-                                        nearest_col = min(range(len(column_clusters)), 
-                                                         key=lambda i: abs(cell_x - column_clusters[i]))
-                                        if aligned_row[nearest_col] == "":
-                                            aligned_row[nearest_col] = cell_text
-                                        else:
-                                            aligned_row[nearest_col] += " " + cell_text
-                                        break
-                            aligned_rows.append(aligned_row)
-                        
-                        rows = aligned_rows
-        
-        return rows
+            for row in rows:
+                aligned_row = ["" for _ in range(n_cols)]
+                for i, nearest_col in zip(row.tolist(), col_ids[row].tolist()):
+                    if aligned_row[nearest_col] == "":
+                        aligned_row[nearest_col] = texts[i]
+                    else:
+                        aligned_row[nearest_col] += " " + texts[i]
+                aligned_rows.append(aligned_row)
+            
+            return aligned_rows
+        
+        return [[texts[i] for i in row.tolist()] for row in rows]
     
     def clean_and_normalize_data(self, rows: List[List[str]]) -> pd.DataFrame:
         """Clean and normalize table data"""
         if not rows:
             return pd.DataFrame()
         
-        row_lengths = [len(row) for row in rows]
-        num_columns = max(set(row_lengths), key=row_lengths.count) if row_lengths else 0
+        # Most common row length wins; ties go to the narrower layout
+        length_counts = Counter(map(len, rows))
+        top_count = max(length_counts.values())
+        num_columns = min(length for length, count in length_counts.items() if count == top_count)
         
         if num_columns == 0:
             return pd.DataFrame()
         
-        normalized_rows = []
-        for row in rows:
-            row = [str(item) if item else '' for item in row]
-            
-            if len(row) < num_columns:
-                row.extend([''] * (num_columns - len(row)))
-            elif len(row) > num_columns:
-                row = row[:num_columns]
-            
-            normalized_rows.append(row)
-        
-        header_row = normalized_rows[0] if normalized_rows else []
-        data_rows = normalized_rows[1:] if len(normalized_rows) > 1 else []
+        # Truncate or pad every row to num_columns in a single pass
+        padded = [
+            [str(item) if item else '' for item in row[:num_columns]] + [''] * (num_columns - len(row))
+            for row in rows
+        ]
         
-        if data_rows:
-            df = pd.DataFrame(data_rows, columns=header_row if header_row else None)
-        else:
-            df = pd.DataFrame(columns=header_row if header_row else None)
-        
-        df = df.replace('', np.nan)
-        
-        for col in df.columns:
-            try:
-                df[col] = pd.to_numeric(df[col], errors='ignore')
-            except Exception:
-                pass
-        
-        return df
+        df = pd.DataFrame(padded[1:], columns=padded[0])
+        return df.replace('', np.nan).apply(pd.to_numeric, errors='ignore')
     
-    def extract_table_from_image(self, image_path: str) -> Dict:
-        """Main extraction pipeline"""
-        start_time = time.time()
+    def _failed_result(self, error: str, start_time: float) -> Dict:
+        """Result dict for an image that could not be converted"""
+        return {
+            "success": False,
+            "error": error,
+            "rows_extracted": 0,
+            "columns_detected": 0,
+            "data": None,
+            "confidence": 0,
+            "processing_time_seconds": round(time.time() - start_time, 2),
+            "backend": self.backend
+        }
+    
+    def _build_table_result(self, text_positions: TextPositions, start_time: float) -> Dict:
+        """Turn positioned text into the table result dict"""
         try:
-            text_positions = self.extract_text_with_positions(image_path)
-            
             if not text_positions:
-                return {
-                    "success": False,
-                    "error": "No text detected",
-                    "rows_extracted": 0,
-                    "columns_detected": 0,
-                    "data": None,
-                    "confidence": 0,
-                    "processing_time_seconds": round(time.time() - start_time, 2),
-                    "backend": self.backend
-                }
+                return self._failed_result("No text detected", start_time)
             
             rows = self.detect_table_structure(text_positions)
             
             if not rows:
-                return {
-                    "success": False,
-                    "error": "Could not detect table structure",
-                    "rows_extracted": 0,
-                    "columns_detected": 0,
-                    "data": None,
-                    "confidence": 0,
-                    "processing_time_seconds": round(time.time() - start_time, 2),
-                    "backend": self.backend
-                }
+                return self._failed_result("Could not detect table structure", start_time)
             
             df = self.clean_and_normalize_data(rows)
             
             rows_extracted = len(df)
             columns_detected = len(df.columns)
             preview = df.head(5).to_string() if not df.empty else "No data"
-            avg_conf = sum([conf for _, _, conf in text_positions]) / len(text_positions)
+            avg_conf = float(text_positions.confs.mean())
             
             return {
                 "success": True,
@@ -398,26 +897,63 @@ Extract EVERYTHING you can read, even if confidence is low. Be thorough."""
             }
             
         except Exception as e:
-            return {
-                "success": False,
-                "error": str(e),
-                "rows_extracted": 0,
-                "columns_detected": 0,
-                "data": None,
-                "confidence": 0,
-                "processing_time_seconds": round(time.time() - start_time, 2),
-                "backend": self.backend
-            }
+            return self._failed_result(str(e), start_time)
+    
+    def extract_table_from_image(self, image_path: Union[str, List[str]]) -> Union[Dict, List[Dict]]:
+        """
+        Main extraction pipeline.
+        A single path returns one result dict; a list of paths is OCR'd in one
+        batched call and returns a list of result dicts in the same order.
+        """
+        start_time = time.time()
+        
+        if isinstance(image_path, (list, tuple)):
+            image_paths = list(image_path)
+            try:
+                batch_positions = self.extract_text_with_positions_batch(image_paths)
+            except Exception as e:
+                return [self._failed_result(str(e), start_time) for _ in image_paths]
+            return [self._build_table_result(text_positions, start_time) for text_positions in batch_positions]
+        
+        try:
+            text_positions = self.extract_text_with_positions(image_path)
+        except Exception as e:
+            return self._failed_result(str(e), start_time)
+        return self._build_table_result(text_positions, start_time)
+    
+    def extract_tables_from_images(self, image_paths: List[str], max_workers: Optional[int] = None) -> List[Dict]:
+        """
+        Run the single-image pipeline on many images in parallel threads (OCR_MAX_CONCURRENCY by default).
+        The work is waiting on Vision/Gemini I/O, so threads overlap it fine; API calls
+        still go through the shared concurrency and interval limits, and transient errors are retried.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers or self.max_concurrency) as executor:
+            return list(executor.map(self.extract_table_from_image, image_paths))
     
     def save_to_excel(self, df: pd.DataFrame, output_path: str):
-        """Save DataFrame to Excel"""
-        with pd.ExcelWriter(output_path, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='Laporan')
-            
-            worksheet = writer.sheets['Laporan']
-            for idx, col in enumerate(df.columns):
-                max_length = max(
-                    df[col].astype(str).apply(len).max(),
-                    len(str(col))
-                )
-                worksheet.column_dimensions[chr(65 + idx)].width = min(max_length + 2, 50)
+        """Save DataFrame to Excel, streaming rows through a write-only workbook"""
+        workbook = openpyxl.Workbook(write_only=True)
+        worksheet = workbook.create_sheet('Laporan')
+        
+        # Widths from one stringification of the values; write-only sheets need them before any row
+        widths = np.array([len(str(col)) for col in df.columns], dtype=int)
+        if not df.empty:
+            widths = np.maximum(widths, np.vectorize(len, otypes=[int])(df.values.astype(str)).max(axis=0))
+        for idx, width in enumerate(widths.tolist(), start=1):
+            worksheet.column_dimensions[get_column_letter(idx)].width = min(width + 2, 50)
+        
+        # Same header style df.to_excel wrote: bold, thin border, centered at the top
+        thin = Side(style='thin')
+        header = []
+        for col in df.columns:
+            cell = WriteOnlyCell(worksheet, value=col)
+            cell.font = Font(bold=True)
+            cell.border = Border(left=thin, right=thin, top=thin, bottom=thin)
+            cell.alignment = Alignment(horizontal='center', vertical='top')
+            header.append(cell)
+        worksheet.append(header)
+        
+        for row in df.itertuples(index=False, name=None):
+            worksheet.append([None if pd.isna(value) else value for value in row])
+        
+        workbook.save(output_path)
@@ -0,0 +1,242 @@
+"""
+Tests for advanced_ocr: parity of the table clustering kernels, and the caching and
+fallback rules, run against stub Vision/Gemini clients (no network, no credentials).
+The Numba kernel duplicates the NumPy one as explicit loops, so the two must stay in sync.
+"""
+
+import os
+import sys
+from collections import OrderedDict
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+# Add parent directory to path for imports
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from backend.services import advanced_ocr
+
+requires_numba = pytest.mark.skipif(not advanced_ocr.NUMBA_AVAILABLE, reason="numba not installed")
+
+
+def _assert_same_clusters(ys: np.ndarray, xs: np.ndarray):
+    expected = advanced_ocr._cluster_positions_numpy(ys, xs)
+    actual = advanced_ocr._cluster_positions_jit(ys, xs)
+
+    for name, exp, act in zip(("by_row", "row_ids", "col_ids"), expected[:3], actual[:3]):
+        np.testing.assert_array_equal(act, exp, err_msg=name)
+    assert actual[3] == expected[3]
+
+
+# Small ranges force many equal ys/xs, which exercises the tie-breaking rules
+@requires_numba
+@pytest.mark.parametrize("coord_range", [5, 50, 800, 4000])
+def test_jit_matches_numpy_on_random_layouts(coord_range):
+    rng = np.random.default_rng(coord_range)
+    for _ in range(300):
+        n = int(rng.integers(1, 80))
+        ys = rng.integers(0, coord_range, n).astype(np.int32)
+        xs = rng.integers(0, coord_range, n).astype(np.int32)
+        _assert_same_clusters(ys, xs)
+
+
+@requires_numba
+def test_jit_matches_numpy_on_grid_table():
+    # 5 rows x 3 columns with a little jitter, like a scanned ledger
+    rng = np.random.default_rng(0)
+    ys = np.repeat(np.arange(5) * 60 + 100, 3) + rng.integers(-4, 5, 15)
+    xs = np.tile(np.array([100, 400, 700]), 5) + rng.integers(-10, 11, 15)
+    _assert_same_clusters(ys.astype(np.int32), xs.astype(np.int32))
+
+
+@requires_numba
+def test_jit_matches_numpy_on_single_word():
+    _assert_same_clusters(np.array([10], dtype=np.int32), np.array([20], dtype=np.int32))
+
+
+# --- Stub clients -----------------------------------------------------------
+
+def _vision_word(text: str, x: int, y: int):
+    vertices = [SimpleNamespace(x=x + dx, y=y + dy) for dx, dy in ((-5, -5), (5, -5), (5, 5), (-5, 5))]
+    return SimpleNamespace(
+        symbols=[SimpleNamespace(text=c, confidence=0.9) for c in text],
+        bounding_box=SimpleNamespace(vertices=vertices),
+    )
+
+
+def _vision_response(words):
+    page = SimpleNamespace(blocks=[SimpleNamespace(paragraphs=[SimpleNamespace(words=words)])])
+    return SimpleNamespace(error=SimpleNamespace(message=""), full_text_annotation=SimpleNamespace(pages=[page]))
+
+
+TABLE_WORDS = [_vision_word("Nama", 100, 100), _vision_word("Harga", 300, 100),
+               _vision_word("Buku", 100, 150), _vision_word("5000", 300, 150)]
+
+
+class StubVisionClient:
+    """Vision client whose behaviour the test sets: a list of words, or an exception to raise"""
+    
+    def __init__(self):
+        self.words = TABLE_WORDS
+        self.fail_batches = set()  # indices of batch_annotate_images calls that raise
+        self.calls = 0
+        self.batch_sizes = []
+    
+    def document_text_detection(self, image):
+        self.calls += 1
+        if isinstance(self.words, Exception):
+            raise self.words
+        return _vision_response(self.words)
+    
+    def batch_annotate_images(self, requests):
+        self.calls += 1
+        self.batch_sizes.append(len(requests))
+        if len(self.batch_sizes) - 1 in self.fail_batches:
+            raise RuntimeError("vision down")
+        return SimpleNamespace(responses=[_vision_response(self.words) for _ in requests])
+
+
+class StubGeminiModel:
+    def __init__(self):
+        self.text = "Buku|1|1|90\n5000|1|5|90"
+        self.calls = 0
+    
+    def generate_content(self, parts):
+        self.calls += 1
+        return SimpleNamespace(text=self.text)
+
+
+@pytest.fixture
+def ocr(monkeypatch, tmp_path):
+    """AdvancedOCR on stub Vision (primary) + Gemini (fallback), with an empty cache and memo"""
+    vision_client = StubVisionClient()
+    gemini_model = StubGeminiModel()
+    stub_vision = SimpleNamespace(
+        ImageAnnotatorClient=lambda: vision_client,
+        Image=lambda **kwargs: SimpleNamespace(**kwargs),
+        ImageSource=lambda **kwargs: SimpleNamespace(**kwargs),
+        AnnotateImageRequest=lambda **kwargs: SimpleNamespace(**kwargs),
+        Feature=lambda type_: SimpleNamespace(type_=type_),
+    )
+    stub_vision.Feature.Type = SimpleNamespace(DOCUMENT_TEXT_DETECTION=11)
+    stub_genai = SimpleNamespace(configure=lambda api_key: None, GenerativeModel=lambda name: gemini_model)
+    
+    monkeypatch.setattr(advanced_ocr, "vision", stub_vision, raising=False)
+    monkeypatch.setattr(advanced_ocr, "genai", stub_genai, raising=False)
+    monkeypatch.setattr(advanced_ocr, "GOOGLE_VISION_AVAILABLE", True)
+    monkeypatch.setattr(advanced_ocr, "GEMINI_AVAILABLE", True)
+    monkeypatch.setattr(advanced_ocr, "_memo", OrderedDict())
+    monkeypatch.setenv("GOOGLE_APPLICATION_CREDENTIALS", "stub.json")
+    monkeypatch.setenv("GEMINI_API_KEY", "stub-key")
+    monkeypatch.setenv("OCR_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("OCR_MIN_REQUEST_INTERVAL", "0")
+    
+    instance = advanced_ocr.AdvancedOCR()
+    instance.vision_client = vision_client
+    instance.gemini_model = gemini_model
+    return instance
+
+
+def _images(tmp_path, count):
+    paths = []
+    for i in range(count):
+        path = tmp_path / f"scan{i}.jpg"
+        path.write_bytes(f"image-{i}".encode())  # not decodable, so nothing gets downscaled
+        paths.append(str(path))
+    return paths
+
+
+def _cache_entries(ocr):
+    return list(ocr._cache_dir.glob("*.pkl"))
+
+
+# --- Caching and fallback rules --------------------------------------------
+
+def test_failed_batch_chunk_only_falls_back_for_its_own_images(ocr, tmp_path):
+    paths = _images(tmp_path, 20)
+    ocr.vision_client.fail_batches = {1}
+    
+    results = ocr.extract_text_with_positions_batch(paths)
+    
+    assert ocr.vision_client.batch_sizes == [16, 4]
+    assert ocr.gemini_model.calls == 4
+    assert [r.texts for r in results[:16]] == [["Nama", "Harga", "Buku", "5000"]] * 16
+    assert [r.texts for r in results[16:]] == [["Buku", "5000"]] * 4
+    # Only the Vision results are persisted; the 4 fallbacks get retried next time
+    assert len(_cache_entries(ocr)) == 16
+    assert len(advanced_ocr._memo) == 16
+
+
+def test_unreadable_image_only_falls_back_for_itself(ocr, tmp_path):
+    paths = _images(tmp_path, 3)
+    paths.insert(1, str(tmp_path / "missing.jpg"))
+    
+    results = ocr.extract_text_with_positions_batch(paths)
+    
+    # The other three still go out as one Vision batch; the missing file can't be sent anywhere
+    assert ocr.vision_client.batch_sizes == [3]
+    assert ocr.gemini_model.calls == 0
+    assert [len(r) for r in results] == [4, 0, 4, 4]
+
+
+def test_fallback_result_is_not_cached(ocr, tmp_path):
+    (path,) = _images(tmp_path, 1)
+    ocr.vision_client.words = RuntimeError("vision down")
+    
+    assert ocr.extract_text_with_positions(path).texts == ["Buku", "5000"]
+    assert _cache_entries(ocr) == []
+    assert len(advanced_ocr._memo) == 0
+    
+    # Once Vision is back, a fresh instance goes to Vision instead of a stale Gemini result
+    ocr.vision_client.words = TABLE_WORDS
+    fresh = advanced_ocr.AdvancedOCR()
+    assert fresh.extract_text_with_positions(path).texts == ["Nama", "Harga", "Buku", "5000"]
+    assert ocr.vision_client.calls == 2
+    assert len(_cache_entries(ocr)) == 1
+
+
+def test_empty_result_is_not_cached(ocr, tmp_path):
+    (path,) = _images(tmp_path, 1)
+    ocr.vision_client.words = []
+    ocr.gemini_model.text = ""
+    
+    assert len(ocr.extract_text_with_positions(path)) == 0
+    assert len(ocr.extract_text_with_positions(path)) == 0
+    assert ocr.vision_client.calls == 2
+    assert ocr.gemini_model.calls == 2
+    assert _cache_entries(ocr) == []
+    assert len(advanced_ocr._memo) == 0
+
+
+def test_memo_is_shared_across_instances_and_misses_when_file_changes(ocr, tmp_path):
+    (path,) = _images(tmp_path, 1)
+    
+    first = ocr.extract_text_with_positions(path)
+    first.texts.append("mutated")
+    
+    # The API builds an AdvancedOCR per request, so the memo must outlive the instance
+    assert advanced_ocr.AdvancedOCR().extract_text_with_positions(path).texts == ["Nama", "Harga", "Buku", "5000"]
+    assert ocr.vision_client.calls == 1
+    
+    # Touching the file misses the memo; same bytes, so the disk cache still answers
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    memo_keys = list(advanced_ocr._memo)
+    ocr.extract_text_with_positions(path)
+    assert list(advanced_ocr._memo) != memo_keys
+    assert ocr.vision_client.calls == 1
+    
+    # New bytes miss both the memo and the content hash
+    Path(path).write_bytes(b"a different scan")
+    ocr.extract_text_with_positions(path)
+    assert ocr.vision_client.calls == 2
+
+
+def test_text_positions_compare_by_value():
+    text_positions = advanced_ocr.TextPositions.from_tuples([("Buku", (10, 20), 0.9), ("5000", (10, 80), 0.8)])
+    
+    assert text_positions == text_positions.copy()
+    assert text_positions != advanced_ocr.TextPositions.from_tuples([("Buku", (10, 20), 0.9)])
+    assert advanced_ocr.TextPositions() == advanced_ocr.TextPositions()